@@ -1,15 +1,28 @@
 import os
 import sys
+import time
+import signal
 import logging
 import asyncio
+from collections import OrderedDict
 
 # Zaroori libraries
 from pyrogram import Client, filters
 from pyrogram.types import Message
 from pyrogram.enums import ChatAction
+from pyrogram.errors import FloodWait
 
 # Google Gemini AI library
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+# uvloop (optional): tez event loop. Client banne se pehle install hona zaroori hai,
+# kyunki Pyrogram Client banate waqt hi event loop le leta hai.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # --- Logging Setup (DEBUG level par set karna) ---
 # Isse Pyrogram ke internal messages bhi dikhenge
@@ -31,7 +44,7 @@ try:
     GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
     log.info("✅ STEP 1: Environment variables loaded successfully.")
 except KeyError as e:
-    log.error(f"❌ FATAL: Environment Variable set nahi hai: {e}")
+    log.error("❌ FATAL: Environment Variable set nahi hai: %s", e)
     sys.exit(1)
 
 # --- AI Setup ---
@@ -41,67 +54,335 @@ try:
     ai_model = genai.GenerativeModel('gemini-2.5-flash')
     log.info("✅ STEP 2: Google Gemini AI model successfully configured.")
 except Exception as e:
-    log.error(f"❌ FATAL: AI model configure karte waqt error aaya: {e}")
+    log.error("❌ FATAL: AI model configure karte waqt error aaya: %s", e)
     sys.exit(1)
 
+# --- AI concurrency limit ---
+# Ek saath kitni Gemini requests chal sakti hain. Zyada DMs aane par baaki requests
+# yahin intezaar karengi (backpressure), memory aur API quota par bojh nahi badhega.
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", "4"))
+ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
 # --- Userbot Client ---
+# Ek saath kitne updates handle honge. Handler sirf message ko user ke queue mein daal kar
+# laut aata hai, isliye yeh workers lambe AI calls mein nahi atakte.
+PYRO_WORKERS = int(os.environ.get("PYRO_WORKERS", "16"))
+
 log.info("STEP 3: Initializing Pyrogram Client...")
 app = Client(
     "ai_user_bot_session",
     api_id=API_ID,
     api_hash=API_HASH,
-    session_string=SESSION_STRING
+    session_string=SESSION_STRING,
+    workers=PYRO_WORKERS
 )
 log.info("✅ STEP 3: Pyrogram Client initialized.")
 
 
+# --- Outgoing rate limit (token bucket) ---
+class TokenBucket:
+    """
+    Async token bucket: har second `rate` naye tokens milte hain, zyada se zyada `capacity` tak.
+    Har message bhejne se pehle ek token lena padta hai, taaki hum khud speed control karein
+    aur Telegram ka FloodWait na aaye.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        FloodWait ke baad sabhi senders ko `seconds` tak rokta hai: tokens ko itna negative kar dete hain
+        ki agla token `seconds` ke baad hi bane. Kai FloodWait ek saath aayein to sabse lamba wala maana jata hai.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+SEND_RATE = float(os.environ.get("SEND_RATE", "5"))
+send_bucket = TokenBucket(rate=SEND_RATE, capacity=max(1, int(SEND_RATE)))
+
+
+# Ek reply ke liye kul itne second tak hi FloodWait ka intezaar karenge, uske baad error
+FLOOD_WAIT_MAX_SECONDS = 120
+
+
+async def safe_reply_text(message: Message, text: str):
+    """
+    Rate limit ke saath reply bhejta hai. FloodWait aane par poora send_bucket Telegram jitna kahe
+    utna ruk jata hai, phir dobara koshish hoti hai, jab tak kul intezaar FLOOD_WAIT_MAX_SECONDS
+    se zyada na ho jaye.
+    """
+    waited = 0
+    while True:
+        async with send_bucket:
+            try:
+                return await message.reply_text(text)
+            except FloodWait as e:
+                waited += e.value
+                if waited > FLOOD_WAIT_MAX_SECONDS:
+                    raise
+                log.warning("FloodWait aaya, sab replies %s second ruk kar dobara bhejenge...", e.value)
+                # Sirf yeh reply nahi, saare senders rukenge; agli baar bucket se token e.value ke baad hi milega
+                send_bucket.pause(e.value)
+
+
+# --- AI call helper ---
+# Gemini ke aise errors jo thodi der baad khud theek ho jaate hain (rate limit, server busy)
+AI_RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+AI_MAX_RETRIES = 3
+
+
+async def generate_ai_response(prompt: str):
+    delay = 1
+    for attempt in range(AI_MAX_RETRIES + 1):
+        try:
+            # Async call, taaki AI ke jawab ka intezaar karte waqt event loop block na ho
+            async with ai_semaphore:
+                return await ai_model.generate_content_async(prompt)
+        except AI_RETRYABLE_ERRORS as e:
+            if attempt == AI_MAX_RETRIES:
+                raise
+            log.warning(
+                "Gemini error (%s), %s second baad dobara koshish (%d/%d)...",
+                type(e).__name__, delay, attempt + 1, AI_MAX_RETRIES
+            )
+        # Semaphore chhod kar rukte hain, taaki doosre users ki requests na atkein
+        await asyncio.sleep(delay)
+        delay *= 2
+
+
+# --- Per-user queues ---
+# Har user ka apna queue aur apna drain task hai: ek user ke messages ek ke baad ek process
+# hote hain (taaki jawab order mein jayein), lekin handler sirf queue mein daal kar turant
+# laut aata hai. Isliye ek user ki atki hui baatcheet sirf usi ko rokti hai, Pyrogram ke
+# workers ko nahi. Gemini calls ki kul sankhya ai_semaphore se pehle hi simit hai.
+USER_QUEUE_LIMIT = int(os.environ.get("USER_QUEUE_LIMIT", "5"))
+_user_queues: dict[int, asyncio.Queue] = {}
+# Chal rahe drain tasks ka reference, taaki garbage collect na ho jayein aur shutdown par unka intezaar ho sake
+_user_tasks: set[asyncio.Task] = set()
+# Shutdown shuru hone ke baad naye DMs queue mein nahi jayenge
+_shutting_down = False
+
+
+def enqueue_user_message(client: Client, message: Message) -> bool:
+    """Message ko user ke queue mein daalta hai. Queue bhara ho ya shutdown chal raha ho to False."""
+    if _shutting_down:
+        return False
+    user_id = message.from_user.id
+    queue = _user_queues.get(user_id)
+    if queue is None:
+        queue = _user_queues[user_id] = asyncio.Queue(maxsize=USER_QUEUE_LIMIT)
+        task = asyncio.create_task(drain_user_queue(user_id, queue))
+        _user_tasks.add(task)
+        task.add_done_callback(_user_tasks.discard)
+    try:
+        queue.put_nowait((client, message))
+    except asyncio.QueueFull:
+        return False
+    return True
+
+
+# Queue bhara hone par user ko ek baar batate hain ki message chhoota; queue khaali hone tak dobara nahi,
+# taaki har extra DM par ek naya reply na jaye
+_queue_full_notified: set[int] = set()
+
+
+async def notify_queue_full(message: Message):
+    user_id = message.from_user.id
+    if user_id in _queue_full_notified:
+        return
+    _queue_full_notified.add(user_id)
+    # Sirf ek koshish, bina FloodWait retry ke, taaki handler worker na atke
+    try:
+        async with send_bucket:
+            await message.reply_text(
+                "Aapke kai messages pehle se line mein hain, isliye yeh message chhod diya gaya. "
+                "Jawab aane ke baad dobara bhejein."
+            )
+    except Exception as e:
+        log.warning("User %s ko queue-full notice nahi bhej paaye: %s", user_id, e)
+
+
+async def drain_user_queue(user_id: int, queue: asyncio.Queue):
+    try:
+        while not queue.empty():
+            client, message = queue.get_nowait()
+            try:
+                await process_dm(client, message)
+            except Exception:
+                # Ek message fail ho (jaise maafi ka message bhi na jaye) to bhi baaki queue chalti rahe
+                log.exception("User %s ka message %s process karte waqt error.", user_id, message.id)
+    finally:
+        # empty() check aur yahan ke beech koi await nahi, isliye naya message chhoot nahi sakta
+        _user_queues.pop(user_id, None)
+        _queue_full_notified.discard(user_id)
+
+
+# --- Duplicate update guard ---
+# Reconnect ke baad Telegram kabhi-kabhi wahi update dobara bhej deta hai.
+# Haal hi ke (chat_id, message_id) yaad rakhte hain taaki ek DM ka jawab do baar na jaye.
+SEEN_MESSAGES_LIMIT = 1000
+_seen_messages: "OrderedDict[tuple[int, int], None]" = OrderedDict()
+
+
+def is_duplicate(message: Message) -> bool:
+    return (message.chat.id, message.id) in _seen_messages
+
+
+def mark_seen(message: Message):
+    # Sirf queue mein jaane ke baad yaad rakhte hain, taaki chhoote hue message ki redelivery na ruke
+    _seen_messages[(message.chat.id, message.id)] = None
+    if len(_seen_messages) > SEEN_MESSAGES_LIMIT:
+        _seen_messages.popitem(last=False)
+
+
 # --- Helper for long messages ---
 async def send_long_message(message: Message, text: str):
-    # (Yeh function pehle jaisa hi hai)
+    """
+    Agar message lamba hai to use 4096 characters ke chunks mein tod kar bhejta hai.
+    """
     if len(text) <= 4096:
-        await message.reply_text(text)
-    else:
-        # ... (splitting logic) ...
-        pass
+        await safe_reply_text(message, text)
+        return
+
+    log.info("Jawab lamba hai, isliye isse tukdon mein toda ja raha hai...")
+    chunks = []
+    # Lines ko list mein jama karte hain aur size alag se ginte hain,
+    # taaki har line par poori string dobara na banani pade
+    parts = []
+    size = 0
+    # Hum text ko lines ke hisaab se todenge taaki formatting kharaab na ho
+    for line in text.splitlines(keepends=True):
+        n = len(line)
+        if parts and size + n > 4096:
+            chunks.append("".join(parts))
+            parts = []
+            size = 0
+        # Agar ek hi line 4096 se lambi ho, to use bhi seedha tod do
+        while n > 4096:
+            chunks.append(line[:4096])
+            line = line[4096:]
+            n -= 4096
+        parts.append(line)
+        size += n
+
+    if parts:
+        chunks.append("".join(parts))
+
+    for i, chunk in enumerate(chunks):
+        await safe_reply_text(message, chunk)
+        log.info("Chunk %d/%d bheja gaya.", i + 1, len(chunks))
+        # Har message ke beech 1 second ka pause, taaki Telegram spam na samjhe
+        if i < len(chunks) - 1:
+            await asyncio.sleep(1)
 
 
 # --- Message Handler (with detailed logging) ---
 @app.on_message(filters.private & ~filters.me)
 async def handle_ai_dm(client: Client, message: Message):
     sender_id = message.from_user.id
-    log.info(f"--- HANDLER TRIGGERED for user {sender_id} ---")
+    log.info("--- HANDLER TRIGGERED for user %s ---", sender_id)
     
     if not message.text:
         log.warning("Handler triggered, but message has no text. Ignoring.")
         return
+
+    if _shutting_down:
+        log.warning("Userbot band ho raha hai, message %s ignore kiya.", message.id)
+        return
+
+    if is_duplicate(message):
+        log.warning("Duplicate update mila (message %s). Ignoring.", message.id)
+        return
         
-    log.info(f"Message text: '{message.text}'")
+    log.info("Message text: '%s'", message.text)
+
+    if not enqueue_user_message(client, message):
+        log.warning("User %s ka queue bhara hua hai (%d messages). Message %s chhod diya.",
+                    sender_id, USER_QUEUE_LIMIT, message.id)
+        await notify_queue_full(message)
+        return
+
+    mark_seen(message)
 
+
+# --- Typing indicator ---
+async def send_typing_action(client: Client, chat_id: int):
+    # Sirf dikhane ke liye hai: fail ho jaye (FloodWait, user ne block kiya, etc.) to bhi jawab jana chahiye
     try:
-        log.info("Sending 'typing' action...")
-        await client.send_chat_action(chat_id=sender_id, action=ChatAction.TYPING)
-        log.info("✅ 'Typing' action sent.")
+        await client.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    except Exception as e:
+        log.warning("'Typing' action nahi bhej paaye (user %s): %s", chat_id, e)
+
 
-        log.info("Calling Google Gemini AI for a response...")
-        response = ai_model.generate_content(message.text)
+# --- DM processing (har user ke drain task mein chalta hai) ---
+async def process_dm(client: Client, message: Message):
+    sender_id = message.from_user.id
+    try:
+        log.info("Sending 'typing' action aur Google Gemini AI call saath-saath...")
+        # Typing action ka AI call se koi lena-dena nahi, isliye dono ek saath chalte hain
+        _, response = await asyncio.gather(
+            send_typing_action(client, sender_id),
+            generate_ai_response(message.text),
+        )
         log.info("✅ AI ne response generate kar diya hai.")
-        
+    
+        # response.text property har baar parts ko jod kar banti hai, isliye sirf ek baar padhna.
+        # Agar jawab block ho gaya (koi part nahi), to yeh ValueError deti hai - use khaali jawab maano.
+        try:
+            reply_text = response.text
+        except ValueError:
+            reply_text = ""
+
         # Check if response is empty
-        if not response.text:
+        if not reply_text:
             log.warning("AI ne response to diya, lekin usmein text khaali hai.")
-            await message.reply_text("Maaf kijiye, main is par koi टिप्पणी nahi kar sakta.")
+            await safe_reply_text(message, "Maaf kijiye, main is par koi टिप्पणी nahi kar sakta.")
             return
 
-        log.info(f"AI Response Text: '{response.text[:100]}...'") # Sirf pehle 100 characters log karna
-        
+        log.info("AI Response Text: '%s...'", reply_text[:100]) # Sirf pehle 100 characters log karna
+    
         log.info("Ab AI ka jawab bheja ja raha hai...")
-        await send_long_message(message, response.text)
+        await send_long_message(message, reply_text)
         log.info("✅ Poora jawab user ko bhej diya gaya hai.")
 
+    except FloodWait as e:
+        # FLOOD_WAIT_MAX_SECONDS se lamba FloodWait: maafi ka message bhi isi wait mein phansega, isliye sirf log
+        log.error("FloodWait (%s second) limit se zyada, user %s ko jawab nahi bhej paaye.", e.value, sender_id)
+
     except Exception as e:
         # YEH SABSE ZAROORI HAI: HAR ERROR KO LOG KARNA
-        log.exception(f"❌❌❌ HANDLER KE ANDAR EK UNEXPECTED ERROR AAYA ❌❌❌")
-        await message.reply_text("Maaf kijiye, ek technical samasya aa gayi hai. Main isey theek karne ki koshish kar raha hoon.")
+        log.exception("❌❌❌ HANDLER KE ANDAR EK UNEXPECTED ERROR AAYA ❌❌❌")
+        await safe_reply_text(message, "Maaf kijiye, ek technical samasya aa gayi hai. Main isey theek karne ki koshish kar raha hoon.")
 
 
 @app.on_message(filters.command("alive") & filters.me)
@@ -111,8 +392,62 @@ async def alive_command(client: Client, message: Message):
 
 
 # --- Userbot ko chalana ---
-if __name__ == "__main__":
+# Heroku SIGTERM ke 30 second baad SIGKILL bhejta hai; usse pehle band ho jana hai
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "25"))
+
+
+async def main():
     log.info("STEP 4: Starting the Userbot...")
-    app.run()
+    await app.start()
+    log.info("✅ STEP 4: Userbot chal raha hai.")
+
+    # SIGTERM (Heroku/Docker restart) ya SIGINT (Ctrl+C) aane par hi aage badhenge,
+    # taaki app.stop() chal sake aur chal rahe jawab (SHUTDOWN_TIMEOUT tak) poore ho sakein.
+    # Doosra signal aane par intezaar chhod kar turant band karte hain.
+    global _shutting_down
+    stop_event = asyncio.Event()
+    force_stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def request_stop():
+        if stop_event.is_set():
+            force_stop_event.set()
+        stop_event.set()
+
+    try:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, request_stop)
+            except NotImplementedError:
+                # Windows par add_signal_handler nahi chalta, wahan normal signal handler se loop ko batate hain
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(request_stop))
+
+        await stop_event.wait()
+        log.info("Stop signal mila, userbot band ho raha hai...")
+        _shutting_down = True
+
+        # Ab koi naya drain task nahi banega, isliye yeh set poora hai
+        if _user_tasks:
+            log.info("%d users ke jawab poore hone ka intezaar (max %s second)...", len(_user_tasks), SHUTDOWN_TIMEOUT)
+            drain_wait = asyncio.create_task(asyncio.wait(set(_user_tasks), timeout=SHUTDOWN_TIMEOUT))
+            force_wait = asyncio.create_task(force_stop_event.wait())
+            await asyncio.wait({drain_wait, force_wait}, return_when=asyncio.FIRST_COMPLETED)
+            drain_wait.cancel()
+            force_wait.cancel()
+
+        # Jo ab bhi chal rahe hain unhe cancel karke khatam hone do, taaki koi task pending na rahe
+        remaining = list(_user_tasks)
+        if remaining:
+            log.warning("%d users ke jawab adhoore reh gaye, cancel kar rahe hain.", len(remaining))
+            for task in remaining:
+                task.cancel()
+            await asyncio.gather(*remaining, return_exceptions=True)
+    finally:
+        await app.stop()
+
+
+if __name__ == "__main__":
+    # app.run() wahi event loop use karta hai jis par Client bana hai
+    app.run(main())
     log.info("--- SCRIPT STOPPED ---")
     